@@ -1,17 +1,17 @@
 # ---IMPORTS-------------------------------------------------------------------
 import os
-import re
+import sys
 import json
-import glob
-import random
-import string
-import datetime
+import secrets
+import time
 import argparse
-import threading
-from typing import Any, TextIO, Optional
+import multiprocessing
+import traceback
+from typing import Any, TextIO, Optional, NamedTuple
+from multiprocessing.managers import ListProxy
+from multiprocessing.sharedctypes import Synchronized
 
 from yt_dlp import YoutubeDL
-from yt_dlp.utils import YoutubeDLError
 # -----------------------------------------------------------------------------
 
 
@@ -20,6 +20,17 @@ from yt_dlp.utils import YoutubeDLError
 Links = list[list[str]]
 Settings = dict[str, Any]
 Context = dict[str, Any]
+
+
+class State(NamedTuple):
+	"""
+	The global variables shared with the download processes.
+	"""
+	settings: Settings
+	output: ListProxy
+	all_links: ListProxy
+	completed: Synchronized
+	last_print: Synchronized
 # -----------------------------------------------------------------------------
 
 
@@ -29,6 +40,16 @@ all_links: Links = []
 output: list[str] = []
 settings: Settings = {}
 loading: bool = True
+crashed: int = 0
+# Created by run(), since they are only needed while downloading.
+completed: Synchronized
+last_print: Synchronized
+# -----------------------------------------------------------------------------
+
+
+
+# ---CONSTANTS-----------------------------------------------------------------
+REFRESH_INTERVAL: float = 0.25  # Minimum seconds between two redraws of the output
 # -----------------------------------------------------------------------------
 
 
@@ -57,18 +78,76 @@ def parse_links(filepath: str) -> Links:
 		filepath (str): Path to the source file.
 	"""
 	with open(filepath, 'r') as file:
-		return list(map(lambda x:[x,''], file.read().split('\n')))
+		return [[line.rstrip('\n'), ''] for line in file if line.strip()]
+
+
+def list_files(prefix: str, ext: str) -> set[str]:
+	"""
+	Returns the names of the files that start with the prefix and have the given extension.
+
+	Args:
+		prefix (str): Path prefix of the files, usually the destination folder.
+		ext (str): Extension of the files.
+
+	Returns:
+		set[str]: The matching filenames
+	"""
+	directory, name = os.path.split(prefix)
+	suffix: str = '.' + ext
+	try:
+		with os.scandir(directory or '.') as entries:
+			return {entry.name for entry in entries if entry.name.startswith(name) and entry.name.endswith(suffix)}
+	# The destination is only created once something is downloaded into it.
+	except FileNotFoundError:
+		return set()
+
+
+def build_format(config: Settings) -> str:
+	"""
+	Returns the download format for the config.
+
+	Args:
+		config (Settings): The config for downloading.
+
+	Returns:
+		str: The youtube_dl format to use for downloading
+	"""
+	if config['novideo']:
+		return "bestaudio[acodec^=opus][ext=m4a]/bestaudio[acodec^=mp4a][ext=m4a]"
+
+	else:
+		resolutions: dict[str, int] = {
+			'144p': 144,
+			'240p': 240,
+			'360p': 360,
+			'480p': 480,
+			'720p': 720,
+			'1080p': 1080,
+			'1440p': 1440,
+			'4k': 2160
+		}
+		res: int = resolutions[config['res']]
+
+		return f"(bestvideo[vcodec^=av01][height<={res}][fps>30]/bestvideo[vcodec^=vp9.2][height<={res}][fps>30]/bestvideo[vcodec^=vp9][height<={res}][fps>30]/bestvideo[vcodec^=avc1][height<={res}][fps>30]/bestvideo[height<={res}][fps>30]/bestvideo[vcodec^=av01][height<={res}]/bestvideo[vcodec^=vp9.2][height<={res}]/bestvideo[vcodec^=vp9][height<={res}]/bestvideo[vcodec^=avc1][height<={res}]/bestvideo[height<={res}])+(bestaudio[acodec^=opus]/bestaudio)/best[height<={res}]"
 
 
 def print_output() -> None:
 	"""
 	Prints the download status.
 	"""
-	ext: str = 'm4a' if settings['novideo'] else 'mkv'
-	downloaded: int = len(list(map(lambda x: os.path.split(x)[1], glob.glob(settings['destination'] + '*.' + ext))))
-	print("\033c", end="")  # Clears the console 
-	print(f"Completed: {downloaded}\n")
-	print(''.join(output))
+	# Clears the console and prints the status in a single write.
+	text: str = f"\033cCompleted: {completed.value}\n\n{''.join(output[:])}\n"
+
+	# The Windows console needs the text layer of stdout to show non-ASCII titles.
+	if os.name == 'nt' and sys.stdout.isatty():
+		sys.stdout.write(text)
+		sys.stdout.flush()
+		return
+
+	# Elsewhere the text layer is bypassed, writing until the whole frame is out.
+	payload: memoryview = memoryview(text.encode(sys.stdout.encoding or 'utf-8', errors='replace'))
+	while payload:
+		payload = payload[os.write(sys.stdout.fileno(), payload):]
 # -----------------------------------------------------------------------------
 
 
@@ -78,12 +157,15 @@ class CustomLogger:
 	"""
 	The Logger that is passed to youtube_dl for logging.
 	"""
-	def __init__(self) -> None:
+	def __init__(self, truncate: bool = True) -> None:
 		"""
 		Custom Logger that logs the actual output from YoutubeDL
+
+		Args:
+			truncate (bool, optional): Clears the previous logs. Defaults to True.
 		"""
-		self.log_file: TextIO = open(resolve_path('log.txt'), 'a+')
-		self.log_file.truncate(0)
+		# The workers open it in append mode, so the writes from every process land at the end.
+		self.log_file: TextIO = open(resolve_path('log.txt'), 'w' if truncate else 'a', buffering=1<<16)
 
 	def debug(self, msg: str) -> None:
 		"""
@@ -92,9 +174,11 @@ class CustomLogger:
 		Args:
 			msg (str): The log message
 		"""
-		# Checking for ETA to avoid writing progress to the logs
-		if 'ETA' not in msg:
-			self.log_file.write(msg + '\n')
+		# Checking for ETA to avoid writing progress to the logs, only progress lines can contain it
+		if msg.startswith('[download]') and 'ETA' in msg:
+			return
+		self.log_file.write(msg)
+		self.log_file.write('\n')
 
 	def warning(self, msg: str) -> None:
 		"""
@@ -103,7 +187,8 @@ class CustomLogger:
 		Args:
 			msg (str): The log message
 		"""
-		self.log_file.write(msg + '\n')
+		self.log_file.write(msg)
+		self.log_file.write('\n')
 
 	def error(self, msg: str) -> None:
 		"""
@@ -112,9 +197,11 @@ class CustomLogger:
 		Args:
 			msg (str): The log message
 		"""
-		self.log_file.write(msg + '\n')
+		self.log_file.write(msg)
+		self.log_file.write('\n')
 
-logger: CustomLogger = CustomLogger()
+# Opened by main() and by each worker, not on import, since spawned workers import this module again.
+logger: CustomLogger
 # -----------------------------------------------------------------------------
 
 
@@ -134,25 +221,30 @@ class Downloader:
 	--nosub - Disable subtitles
 	--pp - Assigns random filename
 	"""
-	global logger, settings
-
-	def __init__(self, links: Links, pos: int) -> None:
+	def __init__(self, work: ListProxy, pos: int) -> None:
 		"""
 		Prepare the downloader with the settings.
 
 		Args:
-			links (Links): The settings for downloading.
+			work (ListProxy): The positions of the links left to download, shared between the downloaders.
 			pos (int): The position of output		
 		"""
-		self.links: list = list(map(lambda x: x[0], links))
+		self._settings: Settings = settings
+		self.work: ListProxy = work
 		self.pos: int = pos
-		self.current: int = 0
+		self.row: Optional[int] = None
+		self.finished: set[str] = set()
+		self._novideo: bool = self._settings['novideo']
+		self._dl_ext: str = 'm4a' if self._novideo else 'mp4'
+		self._want_subs: bool = not self._novideo
+		self._dest_prefix: str = self._settings['destination']
+		self._tpl: str = "{name:<12}\t\t{pct}\n{d} / {s} MB | {sp} MB/s\n{eta}\n\n"
 		self.total: int = len(all_links)
 
 		self.context: Context = {
 			'format': self._select_format(),
 			'ignoreerrors': True,
-			'outtmpl': settings['destination'] + self._generate_name(),
+			'outtmpl': self._dest_prefix + self._generate_name(),
 			'writesubtitles': self._set_subs(),
 			'writeautomaticsub': self._set_subs(),
 			'merge_output_format': 'mp4',
@@ -165,11 +257,11 @@ class Downloader:
 		}
 
 		# Skips postprocessing for audio
-		if not settings['novideo']:
+		if not self._novideo:
 			self.context['postprocessors'] = [
 					{
 						'key': 'FFmpegVideoConvertor',
-						'preferedformat': settings['format'],
+						'preferedformat': self._settings['format'],
 					}, 
 					{
 						'key': 'FFmpegSubtitlesConvertor',
@@ -190,9 +282,9 @@ class Downloader:
 		"""
 		if e['status'] == 'downloading':
 			# Sanitizing the data for output
-			filename: str = re.sub(settings['destination'], '', e['filename'])
+			filename: str = e['filename'].removeprefix(self._dest_prefix)
 			short_filename: str = filename if len(filename) < 25 else filename[:25] + '...' + filename[filename.rindex('.')-5:]
-			eta: str = self._parse_time(datetime.timedelta(seconds=round(e.get('eta') or 0)))
+			eta: str = self._parse_time(round(e.get('eta') or 0))
 			size: float = round((e.get('total_bytes') or e.get('total_bytes_estimate') or -1000000) / 1000000, 2)
 			downloaded: int = round(e['downloaded_bytes'] / 1000000, 2)
 			speed: float = round((e.get('speed') or 0) / 1000000, 2)
@@ -200,9 +292,31 @@ class Downloader:
 
 			self._map_filename(filename)
 			
-			output[self.pos] = (f"{short_filename.ljust(12)}\t\t{'Done' if progress == 100 else str(progress) + '%'}\n{downloaded} / {size} MB | {speed} MB/s\n{eta}\n\n")
-
-			print_output()
+			output[self.pos] = self._tpl.format(name=short_filename, pct='Done' if progress == 100 else f'{progress}%', d=downloaded, s=size, sp=speed, eta=eta)
+
+			# Redraws are throttled and skipped if another process is already redrawing.
+			# The lock is taken first since reading the value would wait for it.
+			if last_print.get_lock().acquire(block=False):
+				try:
+					now: float = time.monotonic()
+					if now - last_print.value > REFRESH_INTERVAL:
+						last_print.value = now
+						print_output()
+				finally:
+					last_print.get_lock().release()
+
+		elif e['status'] == 'finished':
+			# A video with separate formats finishes once per format, so it is counted only once.
+			video_id: str = e.get('info_dict', {}).get('id', '')
+			if video_id and video_id not in self.finished:
+				self.finished.add(video_id)
+				with completed.get_lock():
+					completed.value += 1
+
+			# Completions are always shown, waiting for any redraw in progress.
+			with last_print.get_lock():
+				last_print.value = time.monotonic()
+				print_output()
 
 
 	def _map_filename(self, filename):
@@ -212,26 +326,24 @@ class Downloader:
 		Args:
 			filename (str): name of the downloading file.
 		"""
-		ext: str = 'm4a' if settings['novideo'] else 'mp4'
-
-		if len(self.links) > self.current:
-				for i, link in enumerate(all_links):
-					# If filename is already defined we can ignore it
-					if link[1]: continue
-					if link[0] == self.links[self.current]:
-						all_links[i][1] = f"{filename.rsplit('.', 2)[0]}.{ext}"
-						self.current += 1
-						break
-
-
-	def _parse_time(self, time: datetime.timedelta) -> str:
-		out: str = ''
-		if time:
-			hours, minutes, seconds = list(map(lambda x: int(x), str(time).split(':')))
-			if hours: out = out + f"{hours} hour{'s' if hours > 1 else ''} "
-			if minutes: out = out + f"{minutes} minute{'s' if minutes > 1 else ''} "
-			if seconds: out = out + f"{seconds} second{'s' if seconds > 1 else ''} "
-		return out + 'left' if out else ''
+		# The link is mapped only with the first file it downloads
+		if self.row is not None:
+			link: list[str] = all_links[self.row]
+			# If filename is already defined we can ignore it
+			if not link[1]:
+				# Items of the shared list are copies, so the whole row is replaced.
+				all_links[self.row] = [link[0], f"{filename.rsplit('.', 2)[0]}.{self._dl_ext}"]
+			self.row = None
+
+
+	def _parse_time(self, seconds: int) -> str:
+		hours, seconds = divmod(seconds, 3600)
+		minutes, seconds = divmod(seconds, 60)
+		parts: list[str] = []
+		if hours: parts.append(f"{hours} hour{'s' if hours > 1 else ''}")
+		if minutes: parts.append(f"{minutes} minute{'s' if minutes > 1 else ''}")
+		if seconds: parts.append(f"{seconds} second{'s' if seconds > 1 else ''}")
+		return ' '.join(parts) + ' left' if parts else ''
 
 
 	def _select_format(self) -> str:
@@ -241,23 +353,7 @@ class Downloader:
 		Returns:
 			str: The youtube_dl format to use for downloading
 		"""
-		if settings['novideo']:
-			return "bestaudio[acodec^=opus][ext=m4a]/bestaudio[acodec^=mp4a][ext=m4a]"
-
-		else:
-			resolutions: dict[str, int] = {
-				'144p': 144,
-				'240p': 240,
-				'360p': 360,
-				'480p': 480,
-				'720p': 720,
-				'1080p': 1080,
-				'1440p': 1440,
-				'4k': 2160
-			}
-			res: int = resolutions[settings['res']]
-
-			return f"(bestvideo[vcodec^=av01][height<={res}][fps>30]/bestvideo[vcodec^=vp9.2][height<={res}][fps>30]/bestvideo[vcodec^=vp9][height<={res}][fps>30]/bestvideo[vcodec^=avc1][height<={res}][fps>30]/bestvideo[height<={res}][fps>30]/bestvideo[vcodec^=av01][height<={res}]/bestvideo[vcodec^=vp9.2][height<={res}]/bestvideo[vcodec^=vp9][height<={res}]/bestvideo[vcodec^=avc1][height<={res}]/bestvideo[height<={res}])+(bestaudio[acodec^=opus]/bestaudio)/best[height<={res}]"
+		return self._settings['_format_str']
 
 	
 	def _set_subs(self, no_sub: bool = False) -> bool:
@@ -271,7 +367,7 @@ class Downloader:
 			bool: whether subs are required or not
 		"""
 		if no_sub: return False
-		return True if not settings['novideo'] else False
+		return self._want_subs
 
 
 	def _generate_name(self) -> str:
@@ -281,9 +377,8 @@ class Downloader:
 		Returns:
 			str: Random file name
 		"""
-		if settings['pp']:
-			chars: str = string.ascii_letters + string.digits
-			return f".{''.join(random.choices(chars, k=10))}.%(ext)s"
+		if self._settings['pp']:
+			return f".{secrets.token_urlsafe(8)[:10]}.%(ext)s"
 		else:
 			return '%(title)s.%(ext)s'
 
@@ -292,8 +387,50 @@ class Downloader:
 		"""
 		The main function that starts the download.
 		"""
-		ytdl = YoutubeDL(self.context)
-		ytdl.download(self.links)
+		# A single instance handles every link so that the extractors are loaded only once.
+		with YoutubeDL(self.context) as ytdl:
+			# Takes one link at a time until no links are left.
+			while True:
+				try:
+					self.row = self.work.pop()
+				except IndexError:
+					break
+				ytdl.download([all_links[self.row][0]])
+
+
+def _worker(work: ListProxy, pos: int, state: State) -> None:
+	"""
+	Entry point of each download process.
+
+	Args:
+		work (ListProxy): The positions of the links left to download, shared between processes.
+		pos (int): The position of output
+		state (State): The global variables shared with the processes.
+	"""
+	global settings
+	global output
+	global all_links
+	global completed
+	global last_print
+	global logger
+
+	settings = state.settings
+	output = state.output
+	all_links = state.all_links
+	completed = state.completed
+	last_print = state.last_print
+	# The log was already cleared by the parent process.
+	logger = CustomLogger(truncate=False)
+
+	try:
+		Downloader(work, pos).start()
+	except Exception:
+		# The console is cleared at the end, so the error is kept in the logs.
+		logger.error(traceback.format_exc())
+		raise
+	finally:
+		# The process exits without flushing open files.
+		logger.log_file.flush()
 # -----------------------------------------------------------------------------
 
 
@@ -340,6 +477,7 @@ def main() -> None:
 	"""
 	global settings
 	global all_links
+	global logger
 
 	parser: argparse.ArgumentParser = argparse.ArgumentParser(allow_abbrev=False, prog="tuber", usage="%(prog)s [options] --start", description="A Simple youtube_dl wrapper to download videos and music.")
 
@@ -358,7 +496,10 @@ def main() -> None:
 	args: argparse.Namespace = parser.parse_args()	
 
 	if args.start and not args.config:
+		logger = CustomLogger()
 		settings = config(args)
+		# Built once here so that every downloader shares the same format string.
+		settings['_format_str'] = build_format(settings)
 		all_links = parse_links(settings['source'])
 		run()
 		end()
@@ -375,28 +516,50 @@ def main() -> None:
 
 def run() -> None:
 	"""
-	Initiates the downloads by creating and starting multiple threads for parallel downloads.
+	Initiates the downloads by creating and starting multiple processes for parallel downloads.
 	"""
 	global output
 	global settings
 	global all_links
+	global completed
+	global last_print
+	global crashed
 
-	threads: list[threading.Thread] = []
-	for x in range(settings['threads']):
-		# Spliting the links to make it easier for parallel downloading.
-		dl: Downloader = Downloader(all_links[x::settings['threads']], x)
-		thread: threading.Thread = threading.Thread(target=dl.start)
-		threads.append(thread)
-		# Populating the output based on No.of threads.
-		output.append('')
+	completed = multiprocessing.Value('i', 0)
+	last_print = multiprocessing.Value('d', 0.0)
 
-	# Starts all threads
-	for thread in threads:
-		thread.start()
+	# The manager holds the state that is shared between the processes.
+	with multiprocessing.Manager() as manager:
+		# Populating the output based on No.of processes.
+		output = manager.list([''] * settings['threads'])
+		# The positions of the links are shared so that every row, duplicates included, is mapped by the process that downloads it.
+		# Reversed since the positions are popped from the end.
+		work: ListProxy = manager.list(range(len(all_links) - 1, -1, -1))
+		all_links = manager.list(all_links)
 
-	# Waits for all threads to complete the download
-	for thread in threads:
-		thread.join()
+		# Every global variable the processes need, passed to them as a whole.
+		state: State = State(settings, output, all_links, completed, last_print)
+
+		processes: list[multiprocessing.Process] = []
+		for x in range(settings['threads']):
+			# Every process takes the next link whenever it is free.
+			process: multiprocessing.Process = multiprocessing.Process(target=_worker, args=(work, x, state))
+			processes.append(process)
+
+		# Starts all processes
+		for process in processes:
+			process.start()
+
+		# Waits for all processes to complete the download
+		for process in processes:
+			process.join()
+
+		# The links a crashed process was downloading are left unmapped and reported as failed.
+		crashed = sum(1 for process in processes if process.exitcode != 0)
+
+		# Copying the shared state back before the manager shuts down.
+		output = output[:]
+		all_links = all_links[:]
 
 
 def end() -> None:
@@ -410,8 +573,8 @@ def end() -> None:
 	logger.log_file.close()
 
 	ext: str = 'm4a' if settings['novideo'] else 'mp4'
-	downloaded: list = list(map(lambda x: os.path.split(x)[1], glob.glob(settings['destination'] + '*.' + ext)))
-	failed: list = list(filter(lambda x: x[1] not in downloaded, all_links))
+	downloaded: set[str] = list_files(settings['destination'], ext)
+	failed: Links = [link for link in all_links if link[1] not in downloaded]
 
 	print("\033c", end="")
 
@@ -422,22 +585,20 @@ def end() -> None:
 		with open(os.path.join(settings['destination'],'failed.txt'), 'a') as file:
 			file.seek(0)
 			file.truncate(0)
-			for link in failed:
-				file.write(link[0] + '\n')
+			file.writelines(link[0] + '\n' for link in failed)
 			print("\nDownload Failed!\nCheck 'failed.txt' for failed links.")
 
 	print(f'\nCompleted: {len(downloaded)}/{len(all_links)}')
 	print(f'Failed: {len(failed)}/{len(all_links)}')
+	if crashed:
+		print(f"\n{crashed} download process{'es' if crashed > 1 else ''} crashed.\nCheck 'log.txt' for the errors.")
 #------------------------------------------------------------------------------
 
 
 
 # ---EXECUTION-----------------------------------------------------------------
 if __name__ == "__main__":
-	try:
-		main()
-	except YoutubeDLError:
-		end()
+	main()
 #------------------------------------------------------------------------------ 
 
 